@@ -1,9 +1,248 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+import numpy as np
+import hashlib
+import io
 import os
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # optional: pandas' own CSV parser and writer are used instead
+    pa = None
+
+try:
+    import polars as pl
+except ImportError:  # optional: raw transactions fall back to pandas
+    pl = None
+
+CSV_ENGINE = "pyarrow" if pa is not None else "c"
+
+RFM_COLUMNS = ["Recency", "Frequency", "Monetary"]
+RFM_FILE_COLUMNS = ["CustomerID", "Recency", "Frequency", "Monetary", "Cluster", "Segment",
+                    "R_Score", "F_Score", "M_Score", "RFM_Score"]
+INTEGER_COLUMNS = ["Recency", "Frequency"]
+CATEGORY_COLUMNS = ["Cluster", "Segment"]
+PAIR_PLOT_ROWS = 1000
+PAIR_PLOT_MIN_ROWS_PER_CLUSTER = 50
+CACHE_TTL_SECONDS = 3600
+CACHE_MAX_ENTRIES = 4
+
+
+def downcast_rfm(rfm: pd.DataFrame) -> pd.DataFrame:
+    # Narrow dtypes halve the bytes every later scan and plot touches.
+    # Monetary stays float64: float32 would drop cents from exported balances.
+    for col in INTEGER_COLUMNS:
+        if col in rfm.columns and rfm[col].notna().all():
+            # Smallest integer type that holds the values (int16 for typical data)
+            rfm[col] = pd.to_numeric(rfm[col], downcast="integer")
+    for col in CATEGORY_COLUMNS:
+        if col in rfm.columns:
+            rfm[col] = rfm[col].astype("category")
+    return rfm
+
+
+def rfm_file_columns(raw_bytes: bytes) -> tuple:
+    # (kept, skipped) header columns in file order; a file with no known columns is kept whole
+    header = list(pd.read_csv(io.BytesIO(raw_bytes), nrows=0).columns)
+    kept = [col for col in header if col in RFM_FILE_COLUMNS]
+    if not kept:
+        return header, []
+    return kept, [col for col in header if col not in RFM_FILE_COLUMNS]
+
+
+# Cached loaders: keyed on the uploaded bytes so reruns skip parsing
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL_SECONDS)
+def load_rfm_csv(raw_bytes: bytes) -> tuple:
+    # Only parse the columns the app uses; returns (rfm, skipped column names)
+    kept, skipped = rfm_file_columns(raw_bytes)
+    rfm = pd.read_csv(io.BytesIO(raw_bytes), engine=CSV_ENGINE, usecols=kept)
+    return downcast_rfm(rfm), skipped
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL_SECONDS)
+def load_raw_csv(raw_bytes: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(raw_bytes), engine=CSV_ENGINE, parse_dates=["InvoiceDate"])
+
+
+def quartile_rank(values: np.ndarray, ties: str = "value") -> np.ndarray:
+    # 1-4 quartile from one stable argsort, cutting ranks at 1 + k(n-1)/4 like qcut(rank, 4).
+    # ties="first" breaks ties by row order, matching qcut(rank(method="first"));
+    # ties="value" gives tied values their lowest rank so equal inputs share a score.
+    order = np.argsort(values, kind="stable")
+    ranks = np.arange(1, values.size + 1)
+    if ties == "value":
+        sorted_values = values[order]
+        starts = np.ones(values.size, dtype=bool)
+        starts[1:] = sorted_values[1:] != sorted_values[:-1]
+        ranks = np.maximum.accumulate(np.where(starts, ranks, 0))
+    edges = 1 + np.arange(1, 4) * (values.size - 1) / 4
+    quartiles = np.empty(values.size, dtype=np.int8)
+    quartiles[order] = np.searchsorted(edges, ranks) + 1
+    return quartiles
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL_SECONDS)
+def load_raw_preview(raw_bytes: bytes) -> pd.DataFrame:
+    # The pyarrow engine can't stop early, so the preview uses the C parser
+    return pd.read_csv(io.BytesIO(raw_bytes), nrows=5, parse_dates=["InvoiceDate"])
+
+
+def aggregate_transactions_polars(raw_bytes: bytes):
+    raw = pl.read_csv(raw_bytes, columns=["CustomerID", "InvoiceDate", "Amount"], try_parse_dates=True)
+    if not raw.schema["InvoiceDate"].is_temporal():
+        return None
+    rfm = (
+        raw.lazy()
+        .group_by("CustomerID")
+        .agg(
+            LastDate=pl.col("InvoiceDate").max(),
+            Frequency=pl.col("InvoiceDate").count(),
+            Monetary=pl.col("Amount").sum()
+        )
+        .with_columns(
+            Recency=(pl.col("LastDate").max() + pl.duration(days=1) - pl.col("LastDate")).dt.total_days()
+        )
+        .drop("LastDate")
+        .collect()
+    )
+    return rfm.to_pandas().set_index("CustomerID")
+
+
+def aggregate_transactions(raw_bytes: bytes) -> pd.DataFrame:
+    # Per-customer Frequency / Monetary / Recency, indexed and sorted by CustomerID.
+    # The sort fixes the order Frequency ties are broken in, so scores don't
+    # depend on the row order of the uploaded file.
+    # Polars hands its result to pandas through pyarrow
+    if pl is not None and pa is not None:
+        rfm = aggregate_transactions_polars(raw_bytes)
+        if rfm is not None:
+            return rfm.sort_index()
+
+    raw_df = load_raw_csv(raw_bytes)
+    ref_date = raw_df["InvoiceDate"].max() + pd.Timedelta(days=1)
+    rfm = raw_df.groupby("CustomerID", sort=False).agg(
+        LastDate=("InvoiceDate", "max"),
+        Frequency=("InvoiceDate", "count"),
+        Monetary=("Amount", "sum")
+    )
+
+    rfm["Recency"] = (ref_date - rfm["LastDate"]).dt.days
+    return rfm.drop(columns="LastDate").sort_index()
+
+
+@st.cache_data(show_spinner="Computing RFM…", ttl=CACHE_TTL_SECONDS)
+def compute_rfm(raw_bytes: bytes) -> pd.DataFrame:
+    rfm = aggregate_transactions(raw_bytes)
+
+    r = 5 - quartile_rank(rfm["Recency"].to_numpy())
+    f = quartile_rank(rfm["Frequency"].to_numpy(), ties="first")
+    m = quartile_rank(rfm["Monetary"].to_numpy())
+    rfm["R_Score"], rfm["F_Score"], rfm["M_Score"] = r, f, m
+    # Scores are 1-4, so R*100 + F*10 + M reads the same as the old "RFM" string
+    rfm["RFM_Score"] = r.astype(np.int16) * 100 + f.astype(np.int16) * 10 + m.astype(np.int16)
+    return downcast_rfm(rfm)
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+def summary_metrics(data_key: str, _rfm: pd.DataFrame) -> tuple:
+    # Average Recency, Frequency, Monetary in one pass over the block
+    return tuple(np.nanmean(_rfm[RFM_COLUMNS].to_numpy(np.float64), axis=0))
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+def count_table(data_key: str, _rfm: pd.DataFrame, col: str) -> pd.Series:
+    return _rfm[col].value_counts().sort_values()
+
+
+def upload_key(uploaded_file) -> str:
+    # Taken once per upload and stored with the frame, so caches never rehash the data
+    file_id = getattr(uploaded_file, "file_id", None)
+    return file_id or hashlib.md5(uploaded_file.getvalue()).hexdigest()
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+def rfm_to_csv_bytes(data_key: str, _rfm: pd.DataFrame) -> bytes:
+    if pa is None:
+        return _rfm.to_csv(index=False).encode()
+    buf = io.BytesIO()
+    pa_csv.write_csv(pa.Table.from_pandas(_rfm, preserve_index=False), buf)
+    return buf.getvalue()
+
+
+# Cached figures: kept as singletons so reruns don't redraw static charts.
+# Each is closed once built so pyplot doesn't hold a reference per rerun,
+# and the caches are bounded so old figures are evicted.
+# Plotting libraries are imported lazily so pages without charts skip the cost.
+@st.cache_resource(show_spinner=False)
+def load_plotting():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Global style is set once per process rather than on every rerun
+    sns.set_theme(style="ticks")
+    plt.rcParams.update({"path.simplify": True, "path.simplify_threshold": 1.0, "agg.path.chunksize": 10000})
+    return plt, sns
+
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+def count_bar_fig(counts: tuple, labels: tuple, label_name: str, palette: str):
+    plt, sns = load_plotting()
+    fig, ax = plt.subplots(figsize=(10, 5))
+    sns.barplot(x=list(counts), y=list(labels), hue=list(labels), palette=palette, legend=False, ax=ax)
+    ax.set(xlabel="Count", ylabel=label_name, title=f"Customer Count by {label_name}")
+    plt.close(fig)
+    return fig
+
+
+def stratified_sample(rfm: pd.DataFrame, cols: list) -> pd.DataFrame:
+    # Pick row positions per cluster first so only the sample gets copied
+    rng = np.random.default_rng(1)
+    picks = [
+        rng.choice(pos, min(len(pos), max(PAIR_PLOT_MIN_ROWS_PER_CLUSTER, PAIR_PLOT_ROWS * len(pos) // len(rfm))),
+                   replace=False)
+        for pos in rfm.groupby("Cluster", observed=True, sort=False).indices.values()
+    ]
+    return rfm.iloc[np.sort(np.concatenate(picks)), rfm.columns.get_indexer(cols)]
+
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+def pair_plot_fig(data_key: str, density: bool, _rfm: pd.DataFrame):
+    # density=True bins every row with hexbin instead of scattering a per-cluster sample
+    plt, _ = load_plotting()
+    if density:
+        plot_data = _rfm.loc[:, RFM_COLUMNS]
+    else:
+        plot_data = stratified_sample(_rfm, ['Recency', 'Frequency', 'Monetary', 'Cluster'])
+    # Plot-only copy, so single precision is plenty for Monetary here
+    plot_data = plot_data.astype({"Monetary": "float32"})
+    fig, axes = plt.subplots(3, 3, figsize=(9, 9), sharex="col", sharey="row")
+    for i, ycol in enumerate(RFM_COLUMNS):
+        for j, xcol in enumerate(RFM_COLUMNS):
+            ax = axes[i, j]
+            if i == j:
+                # Twin axis keeps histogram counts off the row's shared y scale
+                hist_ax = ax.twinx()
+                hist_ax.hist(plot_data[xcol], bins=20, color="slategrey")
+                hist_ax.set_yticks([])
+            elif density:
+                ax.hexbin(plot_data[xcol], plot_data[ycol], gridsize=40, cmap="viridis", mincnt=1)
+            else:
+                points = ax.scatter(plot_data[xcol], plot_data[ycol], c=plot_data["Cluster"].cat.codes,
+                                    cmap="viridis", s=4, alpha=0.4, rasterized=True)
+            ax.set_xlabel(xcol if i == 2 else "")
+            ax.set_ylabel(ycol if j == 0 else "")
+    if not density:
+        # num=None gives one handle per plotted code, in sorted code order
+        handles, _ = points.legend_elements(num=None)
+        codes = np.unique(plot_data["Cluster"].cat.codes)
+        fig.legend(handles, list(plot_data["Cluster"].cat.categories[codes]), title="Cluster", loc="center right")
+    plt.close(fig)
+    return fig
+
+
 # App layout config
 st.set_page_config(page_title="RFM Customer Segmentation", layout="wide")
 
@@ -18,21 +257,28 @@ uploaded_file = st.file_uploader("Upload your RFM CSV file", type=["csv"], key="
 
 # Try to read uploaded file
 if uploaded_file is not None:
-    rfm_df = pd.read_csv(uploaded_file)
+    rfm_df, skipped = load_rfm_csv(uploaded_file.getvalue())
+    rfm_key = f"rfm:{upload_key(uploaded_file)}"
     st.session_state.rfm = rfm_df
+    st.session_state.rfm_key = rfm_key
     st.success("✅ File uploaded successfully.")
+    if skipped:
+        st.info(f"ℹ️ Columns not used by the app were skipped and are not in the download: {', '.join(skipped)}")
     st.dataframe(rfm_df.head())
 
 # If not uploaded, check if session already has RFM
 elif "rfm" in st.session_state:
     rfm_df = st.session_state.rfm
+    rfm_key = st.session_state.rfm_key
     st.info("ℹ️ Showing previously uploaded data")
     st.dataframe(rfm_df.head())
 
 # If neither, try loading the fallback sample file
 elif os.path.exists("sample_rfm_data.csv"):
-    rfm_df = pd.read_csv("sample_rfm_data.csv")
+    rfm_df = downcast_rfm(pd.read_csv("sample_rfm_data.csv"))
+    rfm_key = f"sample:{os.path.getmtime('sample_rfm_data.csv')}"
     st.session_state.rfm = rfm_df
+    st.session_state.rfm_key = rfm_key
     st.warning("⚠️ No file uploaded — using sample RFM data.")
     st.dataframe(rfm_df.head())
 
@@ -47,27 +293,13 @@ st.subheader("🔄 Upload Raw Transactions to Compute RFM")
 raw_file = st.file_uploader("Upload raw transactions (CustomerID, InvoiceDate, Amount)", type=["csv"], key="raw")
 
 if raw_file:
-    raw_df = pd.read_csv(raw_file, parse_dates=["InvoiceDate"])
-    st.dataframe(raw_df.head())
+    st.dataframe(load_raw_preview(raw_file.getvalue()))
 
     try:
-        ref_date = raw_df["InvoiceDate"].max() + pd.Timedelta(days=1)
-        rfm = raw_df.groupby("CustomerID").agg({
-            "InvoiceDate": "count",
-            "Amount": "sum"
-        }).rename(columns={
-            "InvoiceDate": "Frequency",
-            "Amount": "Monetary"
-        })
-
-        rfm["Recency"] = raw_df.groupby("CustomerID")["InvoiceDate"].apply(lambda x: (ref_date - x.max()).days)
-
-        rfm["R_Score"] = pd.qcut(rfm["Recency"], 4, labels=[4, 3, 2, 1])
-        rfm["F_Score"] = pd.qcut(rfm["Frequency"].rank(method="first"), 4, labels=[1, 2, 3, 4])
-        rfm["M_Score"] = pd.qcut(rfm["Monetary"], 4, labels=[1, 2, 3, 4])
-        rfm["RFM_Score"] = rfm["R_Score"].astype(str) + rfm["F_Score"].astype(str) + rfm["M_Score"].astype(str)
+        rfm = compute_rfm(raw_file.getvalue())
 
         st.session_state.rfm = rfm
+        st.session_state.rfm_key = f"raw:{upload_key(raw_file)}"
         st.success("✅ RFM computed and stored in session!")
         st.dataframe(rfm.reset_index())
     except Exception as e:
@@ -75,46 +307,40 @@ if raw_file:
 
 # Show summary metrics and visualizations if data exists
 if rfm_df is not None:
+    has_segment = 'Segment' in rfm_df.columns
+    has_cluster = 'Cluster' in rfm_df.columns
+
     st.markdown("---")
     st.subheader("📌 Summary Metrics")
+    avg_r, avg_f, avg_m = summary_metrics(rfm_key, rfm_df)
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("🕒 Avg. Recency", f"{rfm_df['Recency'].mean():.1f} days")
+        st.metric("🕒 Avg. Recency", f"{avg_r:.1f} days")
     with col2:
-        st.metric("🔁 Avg. Frequency", f"{rfm_df['Frequency'].mean():.1f} times")
+        st.metric("🔁 Avg. Frequency", f"{avg_f:.1f} times")
     with col3:
-        st.metric("💰 Avg. Monetary", f"${rfm_df['Monetary'].mean():,.2f}")
+        st.metric("💰 Avg. Monetary", f"${avg_m:,.2f}")
 
     # Horizontal bar chart by Segment or Cluster
     st.markdown("---")
     st.subheader("📊 Customer Counts per Segment / Cluster")
-    if 'Segment' in rfm_df.columns:
-        count_data = rfm_df['Segment'].value_counts().sort_values().reset_index()
-        count_data.columns = ['Segment', 'Count']
-        fig, ax = plt.subplots(figsize=(10, 5))
-        sns.barplot(data=count_data, y='Segment', x='Count', palette='Blues_d', ax=ax)
-        ax.set_title("Customer Count by Segment")
-        st.pyplot(fig)
-    elif 'Cluster' in rfm_df.columns:
-        count_data = rfm_df['Cluster'].value_counts().sort_values().reset_index()
-        count_data.columns = ['Cluster', 'Count']
-        fig, ax = plt.subplots(figsize=(10, 5))
-        sns.barplot(data=count_data, y='Cluster', x='Count', palette='viridis', ax=ax)
-        ax.set_title("Customer Count by Cluster")
+    if has_segment or has_cluster:
+        count_col, palette = ('Segment', 'Blues_d') if has_segment else ('Cluster', 'viridis')
+        count_data = count_table(rfm_key, rfm_df, count_col)
+        fig = count_bar_fig(tuple(count_data), tuple(count_data.index.rename_categories(str)), count_col, palette)
         st.pyplot(fig)
 
     # Pair Plot
     st.markdown("---")
     st.subheader("🔗 RFM Pair Plot by Cluster")
     try:
-        if 'Cluster' in rfm_df.columns:
-            plot_data = rfm_df[['Recency', 'Frequency', 'Monetary', 'Cluster']].copy()
-            if len(plot_data) > 1000:
-                plot_data = plot_data.sample(1000)
-            plot_data['Cluster'] = plot_data['Cluster'].astype(str)
-            sns.set(style="ticks")
-            fig_pair = sns.pairplot(data=plot_data, hue='Cluster', palette='viridis', plot_kws={'alpha': 0.6})
-            st.pyplot(fig_pair)
+        if has_cluster:
+            density = st.toggle("Show density of all customers instead of a per-cluster sample", key="pair_density")
+            if density:
+                st.caption(f"Binning all {len(rfm_df):,} customers; cluster colouring is not shown in this view.")
+            else:
+                st.caption("Proportional sample per cluster, with a floor so small clusters stay visible.")
+            st.pyplot(pair_plot_fig(rfm_key, density, rfm_df))
         else:
             st.warning("'Cluster' column is required for pair plot.")
     except Exception as e:
@@ -123,6 +349,6 @@ if rfm_df is not None:
     # Download section
     st.markdown("---")
     st.subheader("📅 Download Segmented Data")
-    csv = rfm_df.to_csv(index=False)
+    csv = rfm_to_csv_bytes(rfm_key, rfm_df)
     if st.download_button("Download RFM data as CSV", data=csv, file_name="rfm_segmented_output.csv", mime="text/csv"):
         st.success("✅ Download started! Check your browser.")